@@ -2,7 +2,7 @@
 """ Nagios check for security updates
 
 Requirements
-    Python >= 3.8
+    Python >= 3.6
 
 This program is free software: you can redistribute it and/or modify it under
 the terms of the GNU General Public License as published by the Free Software
@@ -18,12 +18,16 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import csv
 import logging
+import os
 import re
+import signal
 import sys
 
 from datetime import date, datetime, timedelta
-from subprocess import run, TimeoutExpired, PIPE
-from typing import Match, Union, Tuple
+from subprocess import Popen, CalledProcessError, TimeoutExpired, PIPE
+from threading import Event, Timer
+from time import time
+from typing import Dict, Iterator, Union, Tuple
 
 __license__ = "GPLv3"
 __version__ = "0.1"
@@ -39,6 +43,21 @@ DEBUG = False
 # Global logging object
 logger = logging.getLogger(__name__)
 
+# Time frames in which patches have to be installed
+_EXPIRY_TD = {30: timedelta(days=30), 90: timedelta(days=90)}
+
+# Marker for patches not found in local cache
+_MISSING = object()
+
+# Precompiled patterns for parsing yum output
+_RE_ALWAYS = re.compile(r"\s*(firefox.*|chrom.*)")
+_RE_SEV = re.compile(r"(Critical|Important|Moderate|Low)/Sec\.\s*(.*)$")
+
+
+def parse_date(date_str: str) -> datetime.date:
+    """Parse date from string starting with YYYY-MM-DD (date.fromisoformat is not available in Python 3.6)"""
+    return datetime.strptime(date_str[:10], "%Y-%m-%d").date()
+
 
 def parseargs() -> argparse.Namespace:
     """ Parse command-line arguments """
@@ -57,7 +76,10 @@ def parseargs() -> argparse.Namespace:
         action='store_true')
     parser.add_argument(
         '-c', '--cache', required=False, default='/tmp/check-security-updates.cache',
-        help='local cache file for patch dates (default: /tmp/check-security-updates.cache)', dest='cache',
+        help='local cache file for patch dates (default: /tmp/check-security-updates.cache)', dest='cache')
+    parser.add_argument(
+        '-n', '--no-cache', required=False,
+        help='do not use local cache file, retrieve all patch dates online', dest='nocache',
         action='store_true')
     parser.add_argument('-V', '--version', action='version', version='%(prog)s ' + __version__)
 
@@ -97,7 +119,7 @@ class Firmware:
 
 
 class Updates:
-    def __init__(self, cache_file:str, nokernel: bool=False):
+    def __init__(self, cache_file:str, nokernel: bool=False, nocache: bool=False):
         self.rc = -1
         self.critical = {}
         self.important = {}
@@ -105,18 +127,41 @@ class Updates:
         self.low = {}
         self.cache_file = cache_file
         self.nokernel = nokernel
+        self.nocache = nocache
         self.next_patchdate = None
         self.expired = False
+        self._cache = {} if nocache else self._load_cache()
+        self._pending = []
+        self._in_use = set()
+        self._today = date.today()
 
-    def run(self, cmd: list, verbose: bool=False):
-        """List security updates and return result"""
-        output = ""
-
+    def _run_command(self, cmd: list, timeout: int = 60) -> Iterator[str]:
+        """Run OS command and return its output line by line while it is running"""
         try:
-            logger.debug(f'Running OS command line: {cmd} ...')
-            process = run(cmd, check=True, timeout=60, stdout=PIPE)
+            logger.debug('Running OS command line: %s ...', cmd)
+            timed_out = Event()
+            with Popen(cmd, stdout=PIPE, encoding='utf-8', bufsize=1, start_new_session=True) as process:
+                # Reading the output blocks until the command and all of its children
+                # have closed the pipe, so kill the whole process group on timeout
+                def kill():
+                    timed_out.set()
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+
+                timer = Timer(timeout, kill)
+                timer.start()
+                try:
+                    for line in process.stdout:
+                        yield line.rstrip('\n')
+                finally:
+                    timer.cancel()
+            if timed_out.is_set():
+                raise TimeoutExpired(cmd, timeout)
+            if process.returncode != 0:
+                raise CalledProcessError(process.returncode, cmd)
             self.rc = process.returncode
-            output = process.stdout.decode('utf-8').splitlines()
         except (TimeoutExpired, ValueError) as e:
             logger.warning(f'{e}')
             sys.exit(UNKNOWN)
@@ -127,84 +172,70 @@ class Updates:
             logger.critical(f'CRITICAL: {e}')
             sys.exit(CRITICAL)
 
-        for line in output:
-            expiration_date = None
-            expired = None
-
-            # Omit kernel patches
-            m = re.search(r"/Sec.\s*(kernel.*)", line)
-            if m and self.nokernel:
-                if verbose:
-                    logger.info(f"Skipping {m.group(1)}")
+    def run(self, cmd: list, verbose: bool=False):
+        """List security updates and return result"""
+        self._today = date.today()
+
+        # Severity -> (result bucket, days until patch has to be installed)
+        severities = {
+            "Critical": (self.critical, 30),
+            "Important": (self.important, 90),
+            "Moderate": (self.moderate, 90),
+            "Low": (self.low, 90),
+        }
+
+        # Collect security patches from list output
+        patches = []
+        for line in self._run_command(cmd):
+            # Skip headers and non-security lines without running any regex
+            if "/Sec." not in line and "firefox" not in line and "chrom" not in line:
                 continue
 
             # Always warn about these packages
-            pkgs = "(firefox.*|chrom.*)"
-            m = re.search(f"\s*{pkgs}", line)
+            m = _RE_ALWAYS.search(line)
             if m:
                 logger.debug(line)
-                self.critical["Critical/Sec.  " + m.group(0).strip()] = datetime.today().strftime("%Y-%m-%d")
+                self.critical["Critical/Sec.  " + m.group(0).strip()] = self._today
                 continue
 
-            # Critical patches
-            m = re.search(r"Critical/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 30)
-                logger.debug(line)
-                self.critical[m.group(0)] = expiration_date
+            # Critical, Important, Moderate and Low patches
+            m = _RE_SEV.search(line)
+            if m:
+                # Omit kernel patches
+                if self.nokernel and m.group(2).startswith("kernel"):
+                    if verbose:
+                        logger.info(f"Skipping {m.group(2)}")
+                    continue
 
-            # Important patches
-            m = re.search(r"Important/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
                 logger.debug(line)
-                self.important[m.group(0)] = expiration_date
+                bucket, days_limit = severities[m.group(1)]
+                patches.append((line.split(None, 1)[0], m.group(0), bucket, days_limit))
 
-            # Moderate patches
-            m = re.search(r"Moderate/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
-                logger.debug(line)
-                self.moderate[m.group(0)] = expiration_date
+        # Retrieve release dates of all patches at once
+        patch_dates = self.get_patch_dates([patch for patch, _, _, _ in patches])
+        self._flush_cache()
 
-            # Low patches
-            m = re.search(r"Low/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
-                logger.debug(line)
-                self.low[m.group(0)] = expiration_date
+        for patch, patch_name, bucket, days_limit in patches:
+            (expired, expiration_date) = self.check_expired(patch_dates[patch], days_limit)
+            bucket[patch_name] = expiration_date
 
             if expired:
                 self.expired = True
 
-            if expiration_date:
-                if not self.next_patchdate:
-                    self.next_patchdate = expiration_date
-                else:
-                    if self.next_patchdate > expiration_date:
-                        self.next_patchdate = expiration_date
+        # Earliest expiration date of all patches with known release date (always-warn packages excluded)
+        self.next_patchdate = min((bucket[patch_name] for _, patch_name, bucket, _ in patches
+                                   if bucket[patch_name] is not None), default=None)
 
         if verbose:
-            # Critical
-            for patch_name, expiration_date in sorted(self.critical.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
-                if expiration_date is None:
-                    expiration_date = "-         "
-                logger.info(f"Patch until {expiration_date} {patch_name}")
-            # Important
-            for patch_name, expiration_date in sorted(self.important.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
-                if expiration_date is None:
-                    expiration_date = "-         "
-                logger.info(f"Patch until {expiration_date} {patch_name}")
-            # Medium
-            for patch_name, expiration_date in sorted(self.moderate.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
-                if expiration_date is None:
-                    expiration_date = "-         "
-                logger.info(f"Patch until {expiration_date} {patch_name}")
-            # Low
-            for patch_name, expiration_date in sorted(self.low.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
-                if expiration_date is None:
-                    expiration_date = "-         "
-                logger.info(f"Patch until {expiration_date} {patch_name}")
+            # Patches without release date are sorted as due today
+            def sort_key(item):
+                return item[1] if item[1] is not None else self._today
+
+            for bucket in (self.critical, self.important, self.moderate, self.low):
+                for patch_name, expiration_date in sorted(bucket.items(), key=sort_key):
+                    if expiration_date is None:
+                        expiration_date = "-         "
+                    logger.info(f"Patch until {expiration_date} {patch_name}")
 
             logger.info(f"Next patch date: {self.next_patchdate}")
 
@@ -231,127 +262,156 @@ class Updates:
         logger.debug(message)
         return result, message
 
-    def check_expired(self, line:str, days_limit: int) -> Tuple[bool, Union[datetime.date,None]]:
-        """Check if time frame for update has expired"""
-        output = ""
-        expiration_date = None
+    def get_patch_dates(self, patches: list) -> Dict[str, Union[datetime.date, None]]:
+        """Retrieve release dates of patches from local cache or online"""
+        patch_dates = {}
+        uncached = []
 
-        m = re.match(r"([^\s]+)\s", line)
-        if m:
-            logger.debug(f"{line}")
-            patch = m.group(0).strip()
+        self._in_use.update(patches)
 
-            # Check if patch is already in local cache
+        # Check if patches are already in local cache
+        for patch in dict.fromkeys(patches):
             is_cached, patch_date = self.check_cache(patch)
             if is_cached:
-                logger.debug(f"Local cache: {patch} {patch_date}")
+                logger.debug("Local cache: %s %s", patch, patch_date)
+                patch_dates[patch] = patch_date
             else:
-                # Retrieve patch info online
-                cmd = ["yum", "updateinfo", "info", f"{patch}"]
+                uncached.append(patch)
+
+        if not uncached:
+            return patch_dates
+
+        # Retrieve info for all uncached patches online with a single call
+        cmd = ["yum", "updateinfo", "info", *uncached]
+
+        # Each advisory starts with its "Update ID", followed by its release date
+        online_dates = {}
+        patch = None
+        for info_line in self._run_command(cmd):
+            stripped = info_line.lstrip()
+            if stripped.startswith("Update ID"):
+                patch = stripped.partition(":")[2].strip() or None
+            elif stripped.startswith(("Updated", "Issued")):
+                if patch is None or patch in online_dates:
+                    continue
                 try:
-                    logger.debug(f'Running OS command line: {cmd} ...')
-                    process = run(cmd, check=True, timeout=60, stdout=PIPE)
-                    self.rc = process.returncode
-                    output = process.stdout.decode('utf-8').splitlines()
-                except (TimeoutExpired, ValueError) as e:
-                    logger.warning(f'{e}')
-                    sys.exit(UNKNOWN)
-                except FileNotFoundError as e:
-                    logger.critical(f"CRITICAL: Missing program {cmd[0] if len(cmd) > 0 else ''} ({e})")
-                    sys.exit(CRITICAL)
-                except Exception as e:
-                    logger.critical(f'CRITICAL: {e}')
-                    sys.exit(CRITICAL)
-    
-                # Write patch date to cache file
-                m2 = None
-                for info_line in output:
-                    #logger.debug(f"{info_line}")
-                    m2 = re.match(r"\s*(Updated|Issued)\s*:\s*(\d+-\d+-\d+ \d+:\d+:\d+)", info_line)
-                    if m2:
-                        patch_date = datetime.strptime(m2.group(2), "%Y-%m-%d %H:%M:%S").date()
-                        if self.update_cache(patch, patch_date):
-                            logger.debug(f"Local cache updated: {patch} {patch_date}")
-                        break
-
-                if m2 is None:
-                    if self.update_cache(patch, None):
-                        logger.debug(f"Local cache updated: {patch} None")
-
-            # Calculate expiration date after which patch has to be installed
-            if patch_date is not None:
-                expiration_date = patch_date + timedelta(days_limit)
-                if date.today() >= expiration_date:
-                    logger.debug(f"Timeframe to patch has expired: {expiration_date} (more than {days_limit} days ago)")
-                    return True, expiration_date
-                else:
-                    logger.debug(f"patch_date={patch_date} days_limit={days_limit} (patch before {patch_date + timedelta(days_limit)})")
-        else:
-            logger.error(f"Patch line has wrong format: {line}")
+                    online_dates[patch] = parse_date(stripped.partition(":")[2].strip())
+                except ValueError:
+                    logger.debug("Invalid release date for %s: %s", patch, stripped)
+
+        # Add patch dates to cache
+        for patch in uncached:
+            patch_date = online_dates.get(patch)
+            patch_dates[patch] = patch_date
+            self.update_cache(patch, patch_date)
+
+        return patch_dates
+
+    def check_expired(self, patch_date: Union[datetime.date, None], days_limit: int) -> Tuple[bool, Union[datetime.date,None]]:
+        """Check if time frame for update has expired"""
+        expiration_date = None
+
+        # Calculate expiration date after which patch has to be installed
+        if patch_date is not None:
+            expiration_date = patch_date + (_EXPIRY_TD.get(days_limit) or timedelta(days=days_limit))
+            if self._today >= expiration_date:
+                logger.debug("Timeframe to patch has expired: %s (more than %d days ago)", expiration_date, days_limit)
+                return True, expiration_date
+            else:
+                logger.debug("patch_date=%s days_limit=%d (patch before %s)", patch_date, days_limit, expiration_date)
 
         return False, expiration_date
 
-    def check_cache(self, patch:str) -> Tuple[bool, Union[datetime.date, None]]:
-        '''Check local cache for patch release date'''
+    def _load_cache(self) -> Dict[str, Union[datetime.date, None]]:
+        '''Read all patch release dates from local cache file'''
+        cache = {}
         try:
             with open(self.cache_file) as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    if row[0] == patch:
-                        if row[1] != "None":
-                            return (True, datetime.strptime(row[1], "%Y-%m-%d").date())
-                        else:
-                            return (True, None)
-        except Exception:
-            pass
+                # Entries are written as "patch,date" and never need quoting
+                for row in csv_file:
+                    patch, _, patch_date = row.rstrip("\n").partition(",")
+                    try:
+                        cache[patch] = None if patch_date == "None" else parse_date(patch_date)
+                    except ValueError:
+                        logger.debug("Ignoring invalid cache entry: %s", row.rstrip("\n"))
+        except (OSError, ValueError) as e:
+            # Missing cache file is created on first update, corrupt one is ignored (UnicodeDecodeError is a ValueError)
+            logger.debug("Cannot read cache file %s: %s", self.cache_file, e)
+            cache = {}
 
-        return (False, None)
+        return cache
+
+    def check_cache(self, patch:str) -> Tuple[bool, Union[datetime.date, None]]:
+        '''Check local cache for patch release date'''
+        patch_date = self._cache.get(patch, _MISSING)
+        if patch_date is _MISSING:
+            return (False, None)
 
-    def update_cache(self, patch:str, patch_date: Union[datetime.date, None]) -> bool:
+        return (True, patch_date)
+
+    def update_cache(self, patch:str, patch_date: Union[datetime.date, None]):
         '''Insert patch release date in local cache'''
+        if self.nocache:
+            return
+
         patch_date_str = patch_date.strftime("%Y-%m-%d") if patch_date else "None"
+        self._cache[patch] = patch_date
+        self._pending.append([patch, patch_date_str])
+        logger.debug("Local cache updated: %s %s", patch, patch_date)
+
+    def _flush_cache(self) -> bool:
+        '''Append new patch release dates to local cache file'''
+        if not self._pending:
+            return True
 
         try:
             with open(self.cache_file, mode='a') as csv_file:
                 patch_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                patch_writer.writerow([patch, patch_date_str])
+                patch_writer.writerows(self._pending)
         except Exception as e:
             logger.error(f"Error writing cache file {self.cache_file}: {e}")
             return False
 
+        logger.debug("Local cache file updated: %d new patches", len(self._pending))
+        self._pending = []
         return True
 
     def clean_cache(self) -> bool:
         '''Delete patch information from cache file that is older than 1 year'''
-        patches = {}
+        if self.nocache:
+            return True
 
-        # Read cache file
+        # Cache file is cleaned at most once a day
+        marker = self.cache_file + ".cleaned"
         try:
-            with open(self.cache_file) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',', fieldnames=['patch_name', 'patch_date'])
-                for row in csv_reader:
-                    patches[row['patch_name']] = row['patch_date']
-        except Exception as e:
-            logger.error(f"Read error while cleaning cache file {self.cache_file}: {e}")
-            return False
+            if time() - os.path.getmtime(marker) < 86400:
+                return True
+        except OSError:
+            pass
 
-        # Write new cache file, sorted by patch date (newest first)
-        # Patches older than 1 year are ignored
-        try:
-            with open(self.cache_file, mode='w') as csv_file:
-                patch_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                for patch_name, patch_date in sorted(patches.items(), key=lambda kv: kv[1] if kv[1] is not None else datetime.today().date(), reverse=True):
-                    try:
-                        dx = datetime.today() - datetime.strptime(patch_date, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        dx = timedelta(0)
+        # Patches that are still pending on this system are kept
+        expired = [patch for patch, patch_date in self._cache.items()
+                   if patch_date is not None and (self._today - patch_date).days >= 365 and patch not in self._in_use]
+
+        # Only rewrite cache file if there is anything to remove
+        if expired:
+            for patch in expired:
+                logger.debug("Removing from cache file: %s %s", patch, self._cache[patch])
+                del self._cache[patch]
+
+            try:
+                with open(self.cache_file, mode='w') as csv_file:
+                    patch_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+                    for patch, patch_date in self._cache.items():
+                        patch_writer.writerow([patch, patch_date.strftime("%Y-%m-%d") if patch_date else "None"])
+            except Exception as e:
+                logger.error(f"Write error while cleaning cache file {self.cache_file}: {e}")
+                return False
 
-                    if dx.days < 365:
-                        patch_writer.writerow([patch_name, patch_date])
-                    else:
-                        logger.debug(f"Removing from cache file: {patch_name} {patch_date}")
+        try:
+            open(marker, mode='w').close()
         except Exception as e:
-            logger.error(f"Write error while cleaning cache file {self.cache_file}: {e}")
+            logger.error(f"Error writing marker file {marker}: {e}")
             return False
 
         return True
@@ -397,7 +457,7 @@ def main():
     get_logger(args.debug)
 
     # Retrieve list of available Linux updates
-    updates = Updates(args.cache, True if args.nokernel else False)
+    updates = Updates(args.cache, True if args.nokernel else False, args.nocache)
     updates.run(['yum', 'updateinfo', 'list'], args.verbose)
     result, message = updates.create_output()
     print(message)